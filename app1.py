@@ -1,11 +1,20 @@
 import os
 import json
+import hashlib
+import httpx
+import orjson
 import streamlit as st
 from dotenv import load_dotenv
 from groq import Groq
 from supabase import create_client
+from cachetools import TTLCache
 import logging
+import random
+import re
+import threading
 import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # === 🔐 Set up logging ===
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -16,45 +25,259 @@ GROQ_API_KEY = os.getenv("GROQ_API_KEY")
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 
-# === 🚀 Initialize clients ===
-client = Groq(api_key=GROQ_API_KEY)
-supabase = create_client(SUPABASE_URL, SUPABASE_KEY)  # type: ignore
+# === 🚀 Initialize clients (cached so Streamlit reruns reuse them) ===
+def build_httpx_client(timeout, **kwargs):
+    """Pooled httpx client so repeat API calls reuse TCP+TLS connections."""
+    return httpx.Client(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=40, keepalive_expiry=60.0),
+        timeout=timeout,
+        **kwargs,
+    )
+
+@st.cache_resource
+def get_groq():
+    return Groq(api_key=GROQ_API_KEY, http_client=build_httpx_client(timeout=30.0))
+
+@st.cache_resource
+def get_supabase():
+    supabase = create_client(SUPABASE_URL, SUPABASE_KEY)  # type: ignore
+    # Swap in a keep-alive client so each query reuses the socket instead of
+    # paying a fresh TLS handshake per Supabase RPC call (keep the auth
+    # headers and base_url postgrest already configured)
+    default_session = supabase.postgrest.session
+    supabase.postgrest.session = build_httpx_client(
+        timeout=15.0,
+        base_url=default_session.base_url,
+        headers=default_session.headers,
+    )
+    return supabase
+
+# === ⏳ Retry backoff helpers ===
+# A fixed 2s sleep over-waits on blips and under-waits on sustained rate
+# limits - and synchronizes every retrying user into a thundering herd.
+NON_RETRYABLE_CODES = ("400", "401", "403", "404", "422")
+
+def is_retryable(error_msg):
+    """Client errors (4xx other than 429) won't succeed on retry."""
+    if "429" in error_msg or "rate" in error_msg.lower():
+        return True
+    return not any(code in error_msg for code in NON_RETRYABLE_CODES)
+
+def retry_delay(attempt, error_msg):
+    """Exponential backoff with jitter; rate limits back off harder."""
+    base = 2 ** attempt
+    if "429" in error_msg or "rate" in error_msg.lower():
+        base *= 2
+    return min(30, base + random.uniform(0, 0.5))
+
+# === 🛡️ SQL validation (reject bad SQL before paying a round-trip) ===
+# The model occasionally hallucinates SQL; catching that locally costs
+# microseconds instead of a full Supabase round-trip, and it keeps anything
+# other than read-only SELECTs on the known tables from ever leaving the app.
+ALLOWED_TABLES = {"departments", "employees", "equipment", "locations", "usage_logs"}
+SQL_COMMENT_RE = re.compile(r"--[^\n]*|/\*.*?\*/", re.S)
+SQL_TABLE_RE = re.compile(r"\b(?:from|join)\s+([a-zA-Z_][a-zA-Z0-9_]*)", re.I)
+SQL_CTE_RE = re.compile(r"\b([a-zA-Z_][a-zA-Z0-9_]*)\s+as\s*\(", re.I)
+SQL_FORBIDDEN_RE = re.compile(r"\b(insert|update|delete|drop|alter|truncate|grant|revoke|create|copy)\b", re.I)
+
+def normalize_sql(sql):
+    """Collapse whitespace and lowercase so equivalent SQL shares a cache key."""
+    return " ".join(sql.split()).lower()
+
+def validate_sql(sql):
+    """Return an error message for unsafe/malformed SQL, or None if it looks fine."""
+    stripped = SQL_COMMENT_RE.sub(" ", sql or "").strip().rstrip(";").strip()
+    if not stripped:
+        return "Empty SQL query"
+    if ";" in stripped:
+        return "Multiple SQL statements are not allowed"
+    first_word = stripped.split(None, 1)[0].lower()
+    if first_word not in ("select", "with"):
+        return "Only SELECT queries are allowed"
+    if SQL_FORBIDDEN_RE.search(stripped):
+        return "Query contains a write/DDL keyword, only read queries are allowed"
+    # CTE aliases are legitimate FROM/JOIN targets within the same query
+    cte_names = {t.lower() for t in SQL_CTE_RE.findall(stripped)}
+    unknown_tables = {t.lower() for t in SQL_TABLE_RE.findall(stripped)} - ALLOWED_TABLES - cte_names
+    if unknown_tables:
+        return f"Unknown table(s): {', '.join(sorted(unknown_tables))}"
+    return None
+
+# === ✂️ Result capping (keep LLM prompts constant-size) ===
+# A broad query can return hundreds of rows, but the user only gets a 1-3
+# sentence summary - cap server-side with LIMIT and client-side by row count.
+MAX_ROWS = 20
+SQL_LIMIT_RE = re.compile(r"\blimit\s+\d+", re.I)
+
+def ensure_limit(sql):
+    """Append a server-side LIMIT when the model didn't write one."""
+    if SQL_LIMIT_RE.search(sql):
+        return sql
+    return f"{sql.strip().rstrip(';')} LIMIT 50"
+
+def cap_rows(rows):
+    """Trim oversized result sets, noting the cut so the model can say so."""
+    if isinstance(rows, list) and len(rows) > MAX_ROWS:
+        capped = rows[:MAX_ROWS]
+        capped.append({"_note": f"{len(rows)} total rows, showing first {MAX_ROWS}"})
+        return capped
+    return rows
+
+# === 🗄️ Query result cache (hot queries skip the Supabase round-trip) ===
+# Short TTL keeps answers fresh enough for status/location questions while
+# letting repeated questions (same user or another) return instantly.
+# Held behind st.cache_resource: Streamlit re-executes this script on every
+# rerun, so a module-level TTLCache would reset each turn and never produce
+# the cross-turn hits it exists for.
+@st.cache_resource
+def get_query_cache():
+    return TTLCache(maxsize=1024, ttl=30), threading.Lock()
+
+def query_cache_key(sql):
+    return hashlib.blake2b(normalize_sql(sql).encode()).hexdigest()
+
+def clear_cache():
+    """Admin helper: drop all cached query results."""
+    query_cache, query_cache_lock = get_query_cache()
+    with query_cache_lock:
+        query_cache.clear()
 
 # === 🛠️ Tool function with retry mechanism ===
 def execute_query_groq(arguments, max_retries=2):
+    query_cache, query_cache_lock = get_query_cache()
     for attempt in range(max_retries + 1):
         try:
-            data = json.loads(arguments)
+            data = orjson.loads(arguments)
             sql = data.get("query")
+
+            # Reject bad SQL locally instead of paying a network round-trip
+            # for Supabase to tell us the same thing
+            validation_error = validate_sql(sql)
+            if validation_error:
+                logging.error(f"Rejected SQL query ({validation_error}): {sql}")
+                return json.dumps({"error": validation_error})
+
+            sql = ensure_limit(sql)
+            cache_key = query_cache_key(sql)
+            with query_cache_lock:
+                cached = query_cache.get(cache_key)
+            if cached is not None:
+                logging.info(f"Cache hit for SQL query: {sql}")
+                return cached
+
             logging.info(f"Executing SQL query (attempt {attempt + 1}): {sql}")
-            
-            result = supabase.rpc("execute_sql", {"query": sql}).execute()
-            result_json = json.dumps(result.data, indent=2)
-            
+
+            result = get_supabase().rpc("execute_sql", {"query": sql}).execute()
+            # Compact form for the payload the model sees - pretty-printing
+            # only inflates tokens and allocations on the hot path, and
+            # orjson serializes large row lists several times faster
+            result_json = orjson.dumps(cap_rows(result.data)).decode()
+
             if not result.data:
                 logging.warning("Query returned empty results")
             else:
-                logging.info(f"Query results: {result_json}")
+                # Lazy %-formatting plus a size cap: large joins shouldn't
+                # allocate megabyte log strings the handler may drop anyway
+                logging.debug("Query results: %s",
+                              result_json if len(result_json) < 4096 else result_json[:4096] + "...[truncated]")
+
+            # Only successful results are cached - errors should always retry
+            with query_cache_lock:
+                query_cache[cache_key] = result_json
             return result_json
             
         except Exception as e:
             error_msg = str(e)
             logging.error(f"Query execution failed (attempt {attempt + 1}): {error_msg}")
-            
-            # If this is not the last attempt, wait a bit before retrying
-            if attempt < max_retries:
-                logging.info(f"Retrying in 2 seconds... (attempt {attempt + 2}/{max_retries + 1})")
-                time.sleep(2)
+
+            # Back off before retrying, but only when a retry can actually help
+            if attempt < max_retries and is_retryable(error_msg):
+                delay = retry_delay(attempt, error_msg)
+                logging.info(f"Retrying in {delay:.1f} seconds... (attempt {attempt + 2}/{max_retries + 1})")
+                time.sleep(delay)
             else:
-                # Final attempt failed, return error
+                # Final attempt failed (or error is non-retryable), return error
                 error_json = json.dumps({"error": error_msg})
                 return error_json
     
     # This should never be reached, but just in case
     return json.dumps({"error": "Maximum retries exceeded"})
 
-# === 🧠 Improved System prompt for First Agent (Query Generator) ===
-system_prompt_agent1 = f"""
+# === 🛠️ Batched variant: several queries in one Supabase round-trip ===
+def execute_query_batch(sql_calls):
+    """Run several execute_query tool calls against Supabase in one RPC.
+
+    Expects [(idx, tool_call), ...] and returns {idx: result_json}. Uses the
+    execute_sql_batch function (queries text[] -> per-query jsonb array) so a
+    3-question turn costs one round-trip instead of three. Cached/invalid
+    queries are settled locally first; if the batch RPC fails, the remaining
+    queries fall back to the parallel per-query path.
+    """
+    query_cache, query_cache_lock = get_query_cache()
+    results = {}
+    pending = []  # (idx, tool_call, sql, cache_key)
+
+    for idx, tool_call in sql_calls:
+        try:
+            sql = orjson.loads(tool_call.function.arguments).get("query")
+        except Exception as e:
+            results[idx] = json.dumps({"error": str(e)})
+            continue
+
+        validation_error = validate_sql(sql)
+        if validation_error:
+            logging.error(f"Rejected SQL query ({validation_error}): {sql}")
+            results[idx] = json.dumps({"error": validation_error})
+            continue
+
+        sql = ensure_limit(sql)
+        cache_key = query_cache_key(sql)
+        with query_cache_lock:
+            cached = query_cache.get(cache_key)
+        if cached is not None:
+            logging.info(f"Cache hit for SQL query: {sql}")
+            results[idx] = cached
+            continue
+
+        pending.append((idx, tool_call, sql, cache_key))
+
+    if len(pending) > 1:
+        try:
+            queries = [sql for _, _, sql, _ in pending]
+            logging.info(f"Executing {len(queries)} SQL queries in one batch RPC")
+            batch = get_supabase().rpc("execute_sql_batch", {"queries": queries}).execute()
+            for (idx, _, _, cache_key), rows in zip(pending, batch.data or []):
+                result_json = orjson.dumps(cap_rows(rows)).decode()
+                with query_cache_lock:
+                    query_cache[cache_key] = result_json
+                results[idx] = result_json
+            # Anything the batch didn't answer falls through to the fallback
+            pending = [entry for entry in pending if entry[0] not in results]
+        except Exception as e:
+            logging.warning(f"Batch RPC failed, falling back to per-query calls: {e}")
+
+    if len(pending) == 1:
+        idx, tool_call, _, _ = pending[0]
+        results[idx] = execute_query_groq(tool_call.function.arguments)
+    elif pending:
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            futures = {
+                executor.submit(execute_query_groq, tool_call.function.arguments): idx
+                for idx, tool_call, _, _ in pending
+            }
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+
+    return results
+
+# === 🧠 Fused system prompt (query generation + result explanation) ===
+# One model handles the whole turn: it decides on tool calls, and after the
+# query results come back it writes the plain-English answer itself. This
+# saves a second system prompt + full LLM round-trip per DB question.
+# Plain string (not an f-string): nothing is interpolated, and a stable
+# byte-identical prompt is what lets provider-side prefix caching kick in.
+system_prompt = """
 You are a hospital database query generator and medical equipment expert. You intelligently decide whether to:
 When user greets no need to give like anything database word or related just greet them back nicely.
 + greet them warmly and encourage them to ask a hospital-related question.
@@ -113,7 +336,7 @@ Do not answer to the question that is not related to hospital equipment, staff,
 ## Query Generation Rules:
 
 ### Format and Structure:
-- Return SQL queries in JSON format: {{"query": "SELECT ..."}}
+- Return SQL queries in JSON format: {"query": "SELECT ..."}
 - Use consistent table aliases: 
   - e for equipment
   - l for locations
@@ -150,26 +373,17 @@ Do not answer to the question that is not related to hospital equipment, staff,
 - Usage history: SELECT emp.name, ul.used_at, ul.action FROM usage_logs ul JOIN employees emp ON ul.employee_id = emp.employee_id WHERE ul.equipment_id = (SELECT equipment_id FROM equipment WHERE name ILIKE '%equipment_name%') ORDER BY ul.used_at DESC
 
 Always ensure queries are syntactically correct and use proper relationships.
-"""
 
-# === 🧠 System prompt for Second Agent (Result Explanation) ===
-system_prompt_agent2 = """
-You are a hospital assistant that explains database query results in plain English.
-When user greets no need to give like anything database word or related just greet them back nicely. 
-+ greet them warmly and encourage them to ask a hospital-related question.
-Take a list of query results (from execute_query tool) and/or direct explanations from the first agent and combine them into a single, clear response.
-Ensure consistency across answers, avoiding conflicting information
-Do not answer to the question that is not related to hospital equipment, staff, or locations. If user asks about something that is not related to hospital equipment, staff, or locations, just say in your words that what you are.
-- Do not mention SQL, tables, or databases in your response.
-
-Your job is to:
-- Take SQL query results and explain them in 1-3 concise, helpful sentences
+## Explaining Results (after the execute_query tool returns):
+Combine the query results and/or your direct explanations into a single, clear response:
+- Explain results in 1-3 concise, helpful sentences
 - Use hospital-friendly, non-technical language
 - Interpret status/action values clearly (e.g., "Available" = "ready to use")
+- Ensure consistency across answers, avoiding conflicting information
 - If results are empty, say: "Sorry, we couldn't find that information. Try a different search term."
 - If there's an error, say: "Sorry, there was an issue getting that information. Please try rephrasing your question."
 - For urgent/emergency equipment, start with "Urgent:" and be direct
-- NEVER mention SQL, tables, databases, or technical details
+- NEVER mention SQL, tables, databases, or technical details in the final answer
 - Focus on what hospital staff need to know
 
 Examples:
@@ -178,6 +392,10 @@ Examples:
 - "The defibrillator is currently available and ready to use."
 """
 
+# Frozen system message built once at import; every call prepends this same
+# object instead of rebuilding the dict per turn
+SYSTEM_MSG = {"role": "system", "content": system_prompt}
+
 # === Tool config for Groq ===
 tools = [{
     "type": "function",
@@ -197,37 +415,148 @@ tools = [{
     }
 }]
 
+# === 🧠 LLM response cache ===
+# Repeat prompts ("What is a ventilator?") shouldn't pay another Groq
+# round-trip. Keyed on the full normalized message list, so a changed DB
+# result (which appears in Agent 2's prompt) naturally misses the cache.
+# cache_resource-backed for the same reason as get_query_cache: module
+# globals reset on every Streamlit rerun.
+@st.cache_resource
+def get_llm_cache():
+    return TTLCache(maxsize=256, ttl=600), threading.Lock()
+
+def llm_cache_key(messages, tools, tool_choice, model):
+    parts = [f"{model}|{'tools' if tools else 'plain'}|{tool_choice}"]
+    for msg in messages:
+        content = " ".join(str(msg.get("content") or "").split()).lower()
+        parts.append(f"{msg.get('role')}|{content}")
+    return hashlib.blake2b("\n".join(parts).encode()).hexdigest()
+
+# === 💬 Explanation replay cache ===
+# Same question + same query results means the same explanation - replay the
+# stored answer and skip the LLM call entirely. Results are part of the key,
+# so fresher DB data automatically misses.
+# cache_resource-backed so replays survive reruns; only the script thread
+# touches it, so no lock needed.
+@st.cache_resource
+def get_explanation_cache():
+    return TTLCache(maxsize=256, ttl=600)
+
+def explanation_cache_key(user_input, query_results):
+    parts = [" ".join(user_input.split()).lower()]
+    parts.extend(query_result["result"] for query_result in query_results)
+    return hashlib.blake2b("\n".join(parts).encode()).hexdigest()
+
 # === Function to create chat completion with retry ===
-def create_chat_completion_with_retry(messages, tools=None, tool_choice="auto", max_retries=2):
+def create_chat_completion_with_retry(messages, tools=None, tool_choice="auto", max_retries=2, stream=False,
+                                      model="llama-3.3-70b-versatile"):
+    llm_cache, llm_cache_lock = get_llm_cache()
+    # Streamed runs are consumed incrementally by the caller, so they can't
+    # be cached as-is - skip the cache for those
+    if not stream:
+        cache_key = llm_cache_key(messages, tools, tool_choice, model)
+        with llm_cache_lock:
+            cached = llm_cache.get(cache_key)
+        if cached is not None:
+            logging.info("LLM cache hit, skipping chat completion call")
+            return cached
+
     for attempt in range(max_retries + 1):
         try:
             logging.info(f"Attempting chat completion (attempt {attempt + 1})")
-            
-            run = client.chat.completions.create(
-                model="llama-3.3-70b-versatile",  # Updated to best model
+
+            # A stable per-session user id lets the provider reuse its KV
+            # cache for our (identical) prompt prefix across turns (session
+            # state isn't available on worker threads, hence the guard)
+            extra_kwargs = {}
+            try:
+                session_id = st.session_state.get("session_id")
+            except Exception:
+                session_id = None
+            if session_id:
+                extra_kwargs["user"] = session_id
+
+            run = get_groq().chat.completions.create(
+                model=model,
                 messages=messages,
                 temperature=0.7,
                 tools=tools,
-                tool_choice=tool_choice # type: ignore
+                tool_choice=tool_choice, # type: ignore
+                stream=stream,
+                **extra_kwargs
             )
-            
+
+            # Cache only successful completions - failures should always retry
+            if not stream:
+                with llm_cache_lock:
+                    llm_cache[cache_key] = run
             return run
-            
+
         except Exception as e:
             error_msg = str(e)
             logging.error(f"Chat completion failed (attempt {attempt + 1}): {error_msg}")
-            
-            # If this is not the last attempt, wait a bit before retrying
-            if attempt < max_retries:
-                logging.info(f"Retrying chat completion in 2 seconds... (attempt {attempt + 2}/{max_retries + 1})")
-                time.sleep(2)
+
+            # Back off before retrying, but only when a retry can actually help
+            if attempt < max_retries and is_retryable(error_msg):
+                delay = retry_delay(attempt, error_msg)
+                logging.info(f"Retrying chat completion in {delay:.1f} seconds... (attempt {attempt + 2}/{max_retries + 1})")
+                time.sleep(delay)
             else:
-                # Final attempt failed, raise the exception
+                # Final attempt failed (or error is non-retryable), raise
                 raise e
     
     # This should never be reached, but just in case
     raise Exception("Maximum retries exceeded for chat completion")
 
+# === ⚡ Speculative explanation polish ===
+# For mixed questions ("What is a ventilator and where is it?") the model
+# attaches explanation text to its tool calls. Polishing that text can run
+# on the 8B model while the Supabase queries are still in flight, so the
+# LLM time overlaps the database wait instead of following it.
+def polish_explanation(draft):
+    run = create_chat_completion_with_retry([
+        {"role": "system", "content": "You polish draft explanations for hospital staff. Rewrite the draft into 2-3 clear, friendly sentences. No SQL, tables, databases, or technical details."},
+        {"role": "user", "content": draft}
+    ], model="llama-3.1-8b-instant")
+    return run.choices[0].message.content
+
+# === 🪟 Sliding window over chat history ===
+# Prompt size (and therefore Groq latency/cost) grows with every turn if the
+# whole session is re-sent. Send only the recent turns verbatim and fold
+# anything older into a short model-written summary.
+MAX_HISTORY = 8
+SUMMARIZE_AFTER = 16
+
+def summarize_history(messages_to_summarize):
+    """Condense older turns into a short note the model can use as context."""
+    transcript = "\n".join(f"{msg['role']}: {msg['content']}" for msg in messages_to_summarize)
+    run = create_chat_completion_with_retry([
+        {"role": "system", "content": "Summarize this hospital assistant conversation in 3-4 sentences. Keep any equipment names, locations, statuses, and staff that were mentioned."},
+        {"role": "user", "content": transcript}
+    ])
+    return run.choices[0].message.content
+
+def build_history_messages():
+    """Recent turns verbatim, older turns as a single summary note."""
+    history = st.session_state.messages
+    messages = []
+
+    if len(history) > SUMMARIZE_AFTER:
+        # Refresh the summary only every MAX_HISTORY turns, not on each rerun
+        if len(history) - st.session_state.get("summary_upto", 0) >= MAX_HISTORY:
+            st.session_state.history_summary = summarize_history(history[:-MAX_HISTORY])
+            st.session_state.summary_upto = len(history)
+        if st.session_state.get("history_summary"):
+            messages.append({
+                "role": "system",
+                "content": f"Summary of the earlier conversation: {st.session_state.history_summary}"
+            })
+
+    # Session messages already have the {"role", "content"} shape Groq
+    # expects, so splice them in as-is instead of copying dict-by-dict
+    messages.extend(history[-MAX_HISTORY:])
+    return messages
+
 # === Streamlit UI ===
 st.set_page_config(
     page_title="🏥 Hospital Assistant",
@@ -264,6 +593,8 @@ st.markdown("""
 # Initialize chat history
 if "messages" not in st.session_state:
     st.session_state.messages = []
+if "session_id" not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex
 
 # Display title and instructions
 st.markdown("""
@@ -288,22 +619,13 @@ if user_input and user_input.strip():
 
     with st.spinner("🤖 Thinking..."):
         try:
-            # messages_agent1 = [
-            #     {"role": "system", "content": system_prompt_agent1},
-            #     {"role": "user", "content": user_input}
-            # ]
-            
-            # Build full conversation history for agent1
-            messages_agent1 = [{"role": "system", "content": system_prompt_agent1}]
-            for msg in st.session_state.messages:
-                messages_agent1.append({"role": msg["role"], "content": msg["content"]})
-
-            
+            # Build windowed conversation history (see build_history_messages)
+            messages = [SYSTEM_MSG, *build_history_messages()]
 
             # Let the model decide whether to use tools or not
-            run = create_chat_completion_with_retry(messages_agent1, tools=tools, tool_choice="auto")
+            run = create_chat_completion_with_retry(messages, tools=tools, tool_choice="auto")
             response = run.choices[0].message
-            logging.info(f"Raw response: {response.content!r}")
+            logging.debug("Raw response: %r", response.content)
 
             # === 🔍 STEP 1: Check if tool calls are present
             has_tool_calls = hasattr(response, "tool_calls") and response.tool_calls
@@ -319,53 +641,114 @@ if user_input and user_input.strip():
             else:
                 # === ⚙️ STEP 3: If there are tool calls, execute them
                 query_results = []
-                final_responses = []
+                polish_future = None
 
                 if has_tool_calls:
+                    sql_calls = []
                     for idx, tool_call in enumerate(response.tool_calls, 1): # type: ignore
                         if tool_call.function.name == "execute_query":
-                            tool_output = execute_query_groq(tool_call.function.arguments)
-                            logging.info(f"Tool call {idx} executed: {tool_call.function.name} → {tool_call.function.arguments}")
-                            query_results.append({"index": idx, "result": tool_output})
+                            sql_calls.append((idx, tool_call))
                         else:
-                            final_responses.append(f"{idx}. ⚠️ Couldn't process part of your request. Try rephrasing.")
-
-                # Collect direct assistant content (e.g., explanation text)
-                if response.content:
-                    if response.content.strip().startswith("1"):
-                        final_responses.extend(response.content.strip().split("\n"))
+                            query_results.append({
+                                "index": idx,
+                                "tool_call_id": tool_call.id,
+                                "result": json.dumps({"error": f"Unknown tool: {tool_call.function.name}"})
+                            })
+
+                    # No context manager: exiting one would block on the
+                    # polish future too, putting it back on the critical path
+                    executor = ThreadPoolExecutor(max_workers=2)
+                    # One Supabase round-trip for the whole batch (with
+                    # cache and per-query fallback handled inside)...
+                    queries_future = executor.submit(execute_query_batch, sql_calls)
+
+                    # ...and, in parallel, polish any explanation text the
+                    # model attached to its tool calls so the LLM work
+                    # overlaps the database wait. Only substantive prose is
+                    # worth the call - tool-call preambles like "I'll check
+                    # that for you." would cost an LLM round-trip and then
+                    # clutter the answer they get prepended to.
+                    draft = (response.content or "").strip()
+                    if len(draft) >= 80 and "." in draft:
+                        polish_future = executor.submit(polish_explanation, draft)
+
+                    batch_results = queries_future.result()
+                    executor.shutdown(wait=False)
+
+                    for idx, tool_call in sql_calls:
+                        tool_output = batch_results[idx]
+                        logging.info(f"Tool call {idx} executed: {tool_call.function.name} → {tool_call.function.arguments}")
+                        query_results.append({"index": idx, "tool_call_id": tool_call.id, "result": tool_output})
+
+                    query_results.sort(key=lambda r: r["index"])
+
+                # === 🤖 STEP 4: Feed tool results back to the SAME model for the final answer
+                # (no separate explainer agent - one system prompt covers both jobs)
+                if query_results:
+                    explanation_cache = get_explanation_cache()
+                    replay_key = explanation_cache_key(user_input, query_results)
+                    cached_explanation = explanation_cache.get(replay_key)
+
+                    if cached_explanation is not None:
+                        # Same question, same results - replay the stored
+                        # answer, zero LLM calls
+                        logging.info("Replaying cached explanation (question and results unchanged)")
+                        final_response = cached_explanation
+                        with st.chat_message("assistant"):
+                            st.markdown(final_response)
                     else:
-                        final_responses.append(response.content)
-
-                # === 🤖 STEP 4: Send to Agent 2 (if needed)
-                if query_results or final_responses:
-                    messages_agent2 = [{"role": "system", "content": system_prompt_agent2}]
-                    for msg in st.session_state.messages:
-                        messages_agent2.append({"role": msg["role"], "content": msg["content"]})
-
-                    for query_result in query_results:
-                        messages_agent2.append({
-                            "role": "function",
-                            "name": "execute_query",
-                            "content": query_result["result"]
-                        })
-
-                    if final_responses and not all("⚠️" in r for r in final_responses):
-                        messages_agent2.append({
-                            "role": "assistant",
-                            "content": "\n".join(final_responses)
-                        })
-
-                    explanation_run = create_chat_completion_with_retry(messages_agent2, tools=None, tool_choice="auto")
-                    final_response = explanation_run.choices[0].message.content
+                        # Collect the speculatively polished explanation (ran
+                        # while the queries were in flight). The queries are
+                        # usually the slow leg; if the polish is the straggler
+                        # instead, move on without it rather than holding up
+                        # the streamed answer
+                        polished_intro = None
+                        if polish_future is not None:
+                            try:
+                                polished_intro = polish_future.result(timeout=1.5)
+                            except Exception as e:
+                                logging.warning(f"Skipping speculative polish (failed or too slow): {e}")
+
+                        # The follow-up only has to explain the current results -
+                        # prior turns add tokens without changing the answer, so
+                        # send just the question, the tool calls, and the results
+                        followup_messages = [
+                            SYSTEM_MSG,
+                            {"role": "user", "content": user_input},
+                            response.model_dump(exclude_none=True),
+                        ]
+                        for query_result in query_results:
+                            followup_messages.append({
+                                "role": "tool",
+                                "tool_call_id": query_result["tool_call_id"],
+                                "content": query_result["result"]
+                            })
+                        if polished_intro:
+                            followup_messages.append({
+                                "role": "system",
+                                "content": "The explanation part of the question is already answered; cover only the database results."
+                            })
+
+                        # === 🧾 STEP 5: Stream the final answer so the first tokens
+                        # appear in ~hundreds of ms instead of after full generation
+                        # Rephrasing rows into 1-3 sentences doesn't need the 70B
+                        # model - the instant 8B model is ~5-10x faster for it
+                        explanation_run = create_chat_completion_with_retry(followup_messages, tools=None, tool_choice="auto",
+                                                                           stream=True, model="llama-3.1-8b-instant")
+                        with st.chat_message("assistant"):
+                            if polished_intro:
+                                st.markdown(polished_intro)
+                            streamed_response = st.write_stream(
+                                chunk.choices[0].delta.content or "" for chunk in explanation_run
+                            )
+                        final_response = f"{polished_intro}\n\n{streamed_response}" if polished_intro else streamed_response
+                        explanation_cache[replay_key] = final_response
                 else:
                     final_response = "⚠️ Sorry, I couldn't understand. Try rephrasing."
+                    with st.chat_message("assistant"):
+                        st.markdown(final_response)
 
-                # === 🧾 STEP 5: Final output from Agent 2
                 st.session_state.messages.append({"role": "assistant", "content": final_response})
-                with st.chat_message("assistant"):
-                    st.markdown(final_response)
-                    # st.success("✅ Done!")
         except Exception as e:
             logging.error(f"Final error after all retries: {str(e)}")
             error_msg = "⚠️ Sorry, there was an issue processing your request. Please try again in a moment."
@@ -1,17 +1,25 @@
 import os
+import functools
 import json
+import orjson
+import re
+import string
+import httpx
 import streamlit as st
+import streamlit.components.v1 as components
 from dotenv import load_dotenv
 from groq import Groq
 from supabase import create_client
+from cachetools import TTLCache
 import logging
+import random
+import threading
 import time
-import tempfile
 from audio_recorder_streamlit import audio_recorder
 import base64
 from io import BytesIO
-import threading
-import queue
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
 
 # === 🔐 Set up logging ===
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -22,104 +30,323 @@ GROQ_API_KEY = os.getenv("GROQ_API_KEY")
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 
-# === 🚀 Initialize clients ===
-client = Groq(api_key=GROQ_API_KEY)
-supabase = create_client(SUPABASE_URL, SUPABASE_KEY)  # type: ignore
+# === 🚀 Initialize clients (cached so Streamlit reruns reuse them) ===
+def build_httpx_client(timeout, **kwargs):
+    """Pooled httpx client so repeat API calls reuse TCP+TLS connections."""
+    return httpx.Client(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=40, keepalive_expiry=60.0),
+        timeout=timeout,
+        **kwargs,
+    )
+
+@st.cache_resource
+def get_groq():
+    return Groq(api_key=GROQ_API_KEY, http_client=build_httpx_client(timeout=30.0))
+
+@st.cache_resource
+def get_supabase():
+    supabase = create_client(SUPABASE_URL, SUPABASE_KEY)  # type: ignore
+    # Swap in a keep-alive client so each query reuses the socket instead of
+    # paying a fresh TLS handshake per Supabase RPC call (keep the auth
+    # headers and base_url postgrest already configured)
+    default_session = supabase.postgrest.session
+    supabase.postgrest.session = build_httpx_client(
+        timeout=15.0,
+        base_url=default_session.base_url,
+        headers=default_session.headers,
+    )
+    return supabase
 
 # === 🎵 Text-to-Speech using Groq ===
-def groq_text_to_speech(text, voice="Judy-PlayAI", model="playai-tts"):
-    """Convert text to speech using Groq TTS API"""
-    try:
-        # Clean text for better speech output
-        clean_text = text.replace('*', '').replace('_', '').replace('#', '')
-        clean_text = ''.join(char for char in clean_text if char.isalnum() or char.isspace() or char in '.,!?-')
-        
-        # Remove emojis and special characters
-        clean_text = ''.join(char for char in clean_text if ord(char) < 128)
-        
-        # Limit text length to avoid API limits
-        if len(clean_text) > 1000:
-            clean_text = clean_text[:1000] + "..."
-        
-        logging.info(f"Generating speech for: {clean_text[:50]}...")
-        
-        # Create speech using Groq API
-        response = client.audio.speech.create(
+# Precomputed deletion table: everything outside letters/digits/whitespace
+# and basic punctuation is dropped in one C-level translate pass.
+_TTS_ALLOWED = set(string.ascii_letters + string.digits + string.whitespace + '.,!?-')
+_TTS_TABLE = {code: None for code in range(128) if chr(code) not in _TTS_ALLOWED}
+
+def _clean_tts_text(text):
+    """One-pass cleanup for synthesis: ASCII-fold (drops emojis), strip
+    markdown symbols via the translate table, cap at the API's 1000 chars."""
+    return text.encode('ascii', 'ignore').decode('ascii').translate(_TTS_TABLE)[:1000]
+
+@st.cache_resource
+def get_tts_synthesizer():
+    """lru-cached synthesis function, held behind st.cache_resource so hits
+    survive Streamlit reruns (module globals - lru tables included - reset
+    on every script execution). Keyed on (cleaned text, voice, model): the
+    WAV is a deterministic function of those, so repeated phrases skip the
+    API. Raises on failure so errors are never cached."""
+    @functools.lru_cache(maxsize=256)
+    def synthesize(clean_text, voice, model):
+        # Create speech using Groq API, streaming the download so chunks
+        # accumulate as they arrive instead of blocking on the full WAV
+        # (a .read() on the buffered response waits for the last byte).
+        # True progressive playback would need a separate HTTP endpoint to
+        # feed a MediaSource - not available in a plain Streamlit app - so
+        # the first-sound win comes from starting the transfer immediately.
+        with get_groq().audio.speech.with_streaming_response.create(
             model=model,
             voice=voice,
             input=clean_text,
             response_format="wav"
-        )
-        
-        audio_bytes = response.read()  # ✅ This reads the binary audio
-        return audio_bytes
+        ) as response:
+            return b"".join(response.iter_bytes(chunk_size=4096))
+    return synthesize
+
+def groq_text_to_speech(text, voice="Judy-PlayAI", model="playai-tts"):
+    """Convert text to speech using Groq TTS API"""
+    try:
+        # Clean text for better speech output (single pass)
+        clean_text = _clean_tts_text(text)
+
+        logging.info(f"Generating speech for: {clean_text[:50]}...")
+
+        return get_tts_synthesizer()(clean_text, voice, model)
 
-        
     except Exception as e:
         logging.error(f"Groq TTS failed: {str(e)}")
         return None
 
+# === ✂️ Sentence chunking for progressive TTS ===
+SENTENCE_SPLIT_RE = re.compile(r'(?<=[.!?])\s+')
+
+def split_into_sentences(text, first_chunk_limit=200):
+    """Split text at sentence boundaries into progressively growing chunks.
+
+    The first chunk is kept small (~200 chars) so its audio comes back fast;
+    later chunks double in size (200 -> 400 -> 800) to limit request count.
+    """
+    sentences = [s for s in SENTENCE_SPLIT_RE.split(text.strip()) if s]
+    chunks = []
+    current = ""
+    limit = first_chunk_limit
+    for sentence in sentences:
+        if current and len(current) + len(sentence) + 1 > limit:
+            chunks.append(current)
+            current = sentence
+            limit = min(limit * 2, 800)
+        else:
+            current = f"{current} {sentence}".strip()
+    if current:
+        chunks.append(current)
+    return chunks
+
+def wav_duration_seconds(wav_bytes):
+    """Playback duration read from the RIFF header's byte-rate field."""
+    try:
+        byte_rate = int.from_bytes(wav_bytes[28:32], "little")
+        return (len(wav_bytes) - 44) / byte_rate if byte_rate else 0.0
+    except Exception:
+        return 0.0
+
+def concat_wav(chunks):
+    """Stitch WAV blobs into one: keep the first canonical 44-byte header,
+    append the raw sample data of the rest, and patch the size fields."""
+    if len(chunks) == 1:
+        return chunks[0]
+    stitched = bytearray(chunks[0] + b"".join(chunk[44:] for chunk in chunks[1:]))
+    stitched[4:8] = (len(stitched) - 8).to_bytes(4, "little")
+    stitched[40:44] = (len(stitched) - 44).to_bytes(4, "little")
+    return bytes(stitched)
+
 # === 🎙️ Voice-to-Text using Groq Whisper ===
-def transcribe_audio(audio_bytes):
+# Staff queries are short English utterances, so the distilled English-only
+# model (~3x faster) is the default; the sidebar toggle switches to the
+# multilingual turbo model for non-English input.
+ASR_MODEL = os.getenv("GROQ_ASR_MODEL", "distil-whisper-large-v3-en")
+ASR_MODEL_MULTILINGUAL = "whisper-large-v3-turbo"
+
+def transcribe_audio(audio_bytes, model=None):
     """Transcribe audio using Groq Whisper model"""
     try:
-        # Create a temporary file for the audio
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.wav') as tmp_file:
-            tmp_file.write(audio_bytes)
-            tmp_file_path = tmp_file.name
-        
-        # Transcribe using Groq Whisper
-        with open(tmp_file_path, 'rb') as audio_file:
-            transcription = client.audio.transcriptions.create(
-                file=audio_file,
-                model="whisper-large-v3",
-                response_format="text"
-            )
-        
-        # Clean up temporary file
-        os.unlink(tmp_file_path)
-        
+        # Upload straight from memory - the SDK accepts a
+        # (filename, fileobj, mimetype) tuple, so no temp file needed
+        transcription = get_groq().audio.transcriptions.create(
+            file=('audio.wav', BytesIO(audio_bytes), 'audio/wav'),
+            model=model or ASR_MODEL,
+            response_format="text"
+        )
+
         return str(transcription).strip()
-    
+
     except Exception as e:
         logging.error(f"Voice transcription failed: {str(e)}")
         return None
 
+# === ⏱️ Retry policy (shared by query + chat retry loops) ===
+NON_RETRYABLE_CODES = ("400", "401", "403", "404", "422")
+
+def is_retryable(error_msg):
+    """Client errors (4xx other than 429) won't succeed on retry."""
+    if "429" in error_msg or "rate" in error_msg.lower():
+        return True
+    return not any(code in error_msg for code in NON_RETRYABLE_CODES)
+
+def retry_delay(attempt, error_msg):
+    """Exponential backoff with jitter; rate limits back off harder."""
+    base = 2 ** attempt
+    if "429" in error_msg or "rate" in error_msg.lower():
+        base *= 2
+    return min(30, base + random.uniform(0, 0.5))
+
+# === 🗃️ Short-TTL cache for query results ===
+# Staff ask the same handful of questions back-to-back ("Where is the
+# ventilator?"); 60s is short enough that status changes still show up.
+# Behind st.cache_resource so the cache outlives the per-message rerun.
+@st.cache_resource
+def get_query_cache():
+    return TTLCache(maxsize=512, ttl=60), threading.Lock()
+
+def query_cache_key(sql):
+    """Canonicalize so cosmetic whitespace/case differences share an entry."""
+    return re.sub(r"\s+", " ", sql.strip().lower())
+
 # === 🛠️ Tool function with retry mechanism ===
 def execute_query_groq(arguments, max_retries=2):
+    query_cache, query_cache_lock = get_query_cache()
     for attempt in range(max_retries + 1):
         try:
-            data = json.loads(arguments)
+            data = orjson.loads(arguments)
             sql = data.get("query")
+
+            cache_key = query_cache_key(sql or "")
+            with query_cache_lock:
+                cached = query_cache.get(cache_key)
+            if cached is not None:
+                logging.info(f"Query cache hit: {sql}")
+                return cached
+
             logging.info(f"Executing SQL query (attempt {attempt + 1}): {sql}")
-            
-            result = supabase.rpc("execute_sql", {"query": sql}).execute()
-            result_json = json.dumps(result.data, indent=2)
-            
+
+            result = get_supabase().rpc("execute_sql", {"query": sql}).execute()
+            # Compact serialization: the output is only read by the LLM,
+            # which is billed for every whitespace token pretty-printing adds
+            result_json = orjson.dumps(result.data).decode()
+
             if not result.data:
                 logging.warning("Query returned empty results")
             else:
                 logging.info(f"Query results: {result_json}")
+            with query_cache_lock:
+                query_cache[cache_key] = result_json
             return result_json
             
         except Exception as e:
             error_msg = str(e)
             logging.error(f"Query execution failed (attempt {attempt + 1}): {error_msg}")
             
-            # If this is not the last attempt, wait a bit before retrying
-            if attempt < max_retries:
-                logging.info(f"Retrying in 2 seconds... (attempt {attempt + 2}/{max_retries + 1})")
-                time.sleep(2)
+            # Back off before retrying, but only when a retry can actually help
+            if attempt < max_retries and is_retryable(error_msg):
+                delay = retry_delay(attempt, error_msg)
+                logging.info(f"Retrying in {delay:.1f} seconds... (attempt {attempt + 2}/{max_retries + 1})")
+                time.sleep(delay)
             else:
-                # Final attempt failed, return error
-                error_json = json.dumps({"error": error_msg})
+                # Retries exhausted or a non-retryable error, return error
+                error_json = orjson.dumps({"error": error_msg}).decode()
                 return error_json
     
     # This should never be reached, but just in case
     return json.dumps({"error": "Maximum retries exceeded"})
 
-# === 🧠 Improved System prompt for First Agent (Query Generator) ===
-system_prompt_agent1 = f"""
+# === 🛠️ Batched SQL execution for multi-question turns ===
+def execute_query_batch(sql_calls):
+    """Run several execute_query tool calls against Supabase in one RPC.
+
+    Expects [(idx, tool_call), ...] and returns {idx: result_json}. Uses the
+    execute_sql_batch function (queries text[] -> per-query jsonb array) so
+    a multi-question turn costs one round-trip instead of several. Cached
+    queries are settled locally first; if the batch RPC fails, whatever is
+    left falls back to the per-query path.
+    """
+    query_cache, query_cache_lock = get_query_cache()
+    results = {}
+    pending = []  # (idx, tool_call, sql, cache_key)
+
+    for idx, tool_call in sql_calls:
+        try:
+            sql = orjson.loads(tool_call.function.arguments).get("query")
+        except Exception as e:
+            results[idx] = json.dumps({"error": str(e)})
+            continue
+
+        cache_key = query_cache_key(sql or "")
+        with query_cache_lock:
+            cached = query_cache.get(cache_key)
+        if cached is not None:
+            logging.info(f"Query cache hit: {sql}")
+            results[idx] = cached
+            continue
+
+        pending.append((idx, tool_call, sql, cache_key))
+
+    if len(pending) > 1:
+        try:
+            queries = [sql for _, _, sql, _ in pending]
+            logging.info(f"Executing {len(queries)} SQL queries in one batch RPC")
+            batch = get_supabase().rpc("execute_sql_batch", {"queries": queries}).execute()
+            for (idx, _, _, cache_key), rows in zip(pending, batch.data or []):
+                result_json = orjson.dumps(rows).decode()
+                with query_cache_lock:
+                    query_cache[cache_key] = result_json
+                results[idx] = result_json
+            # Anything the batch didn't answer falls through to the fallback
+            pending = [entry for entry in pending if entry[0] not in results]
+        except Exception as e:
+            logging.warning(f"Batch RPC failed, falling back to per-query calls: {e}")
+
+    for idx, tool_call, _, _ in pending:
+        results[idx] = execute_query_groq(tool_call.function.arguments)
+
+    return results
+
+# === 🛠️ Prepared-statement lookups ===
+def execute_prepared(name, arguments, max_retries=2):
+    """Run one of the precompiled lookup procedures. The SQL lives
+    server-side as a PL/pgSQL function, so each call skips parse/plan and
+    only ships the typed argument over the wire."""
+    query_cache, query_cache_lock = get_query_cache()
+    for attempt in range(max_retries + 1):
+        try:
+            args = orjson.loads(arguments) if arguments else {}
+
+            cache_key = query_cache_key(f"{name}:{json.dumps(args, sort_keys=True)}")
+            with query_cache_lock:
+                cached = query_cache.get(cache_key)
+            if cached is not None:
+                logging.info(f"Prepared lookup cache hit: {name} {args}")
+                return cached
+
+            logging.info(f"Running prepared lookup (attempt {attempt + 1}): {name} {args}")
+
+            result = get_supabase().rpc(name, args).execute()
+            result_json = orjson.dumps(result.data).decode()
+
+            if not result.data:
+                logging.warning(f"Prepared lookup {name} returned empty results")
+            with query_cache_lock:
+                query_cache[cache_key] = result_json
+            return result_json
+
+        except Exception as e:
+            error_msg = str(e)
+            logging.error(f"Prepared lookup {name} failed (attempt {attempt + 1}): {error_msg}")
+
+            if attempt < max_retries and is_retryable(error_msg):
+                delay = retry_delay(attempt, error_msg)
+                logging.info(f"Retrying in {delay:.1f} seconds... (attempt {attempt + 2}/{max_retries + 1})")
+                time.sleep(delay)
+            else:
+                return json.dumps({"error": error_msg})
+
+    return json.dumps({"error": "Maximum retries exceeded"})
+
+# === 🧠 System prompt, sliced by intent ===
+# The full prompt is ~2500 tokens billed and prefilled on every turn, but
+# most rules don't apply to any given input. A cheap regex classifier picks
+# which slices to send; anything unrecognized still gets the whole prompt.
+PROMPTS = {}
+
+PROMPTS["base"] = """
 You are a hospital database query generator and medical equipment expert. You intelligently decide whether to:
 When user greets no need to give like anything database word or related just greet them back nicely.
 + greet them warmly and encourage them to ask a hospital-related question.
@@ -139,14 +366,10 @@ Do not answer to the question that is not related to hospital equipment, staff,
 - "What is a ventilator and where is it?" → Both explanation + database query
 - "What's the status of the ECG machine?" → Database query (even though it contains "what")
 
-**For Medical Explanations:**
-- Use your medical knowledge to provide clear, helpful explanations
-- Keep explanations concise but informative (2-3 sentences)
-- Focus on what the equipment does and why it's important
-
 **For Database Queries:**
-- ALWAYS use the 'execute_query' tool to run SQL queries
-- Generate accurate SQL based on the schema provided
+- PREFER the typed lookup tools (locate_equipment, equipment_status, usage_history, staff_in_dept, equipment_in_building) - they cover the common questions directly
+- Only fall back to the 'execute_query' tool with raw SQL when no typed lookup fits the question
+- When writing SQL, generate accurate queries based on the schema provided
 - DO NOT return raw JSON or mention technical details
 
 **IMPORTANT**: 
@@ -174,11 +397,20 @@ Do not answer to the question that is not related to hospital equipment, staff,
 - Equipment is located at specific locations (equipment.location_id → locations.location_id)
 - Equipment tracks last user (equipment.last_used_by → employees.employee_id)
 - Usage logs track equipment usage by employees (usage_logs.equipment_id → equipment.equipment_id, usage_logs.employee_id → employees.employee_id)
+"""
 
+PROMPTS["explain"] = """
+**For Medical Explanations:**
+- Use your medical knowledge to provide clear, helpful explanations
+- Keep explanations concise but informative (2-3 sentences)
+- Focus on what the equipment does and why it's important
+"""
+
+PROMPTS["sql"] = """
 ## Query Generation Rules:
 
 ### Format and Structure:
-- Return SQL queries in JSON format: {{"query": "SELECT ..."}}
+- Return SQL queries in JSON format: {"query": "SELECT ..."}
 - Use consistent table aliases: 
   - e for equipment
   - l for locations
@@ -192,107 +424,277 @@ Do not answer to the question that is not related to hospital equipment, staff,
 - For ALL text/string column comparisons, ALWAYS use ILIKE with wildcards (e.g., ILIKE '%search_term%')
 - NEVER use = (equals) for text comparisons unless doing exact ID matching
 - This applies to columns: name, role, model, type, status, building, room_number, action
+- Equipment search pattern: SELECT e.name, e.model, e.type, e.status FROM equipment e WHERE e.name ILIKE '%search_term%'
+
+## Explaining Results:
+After a tool call returns, explain the results in plain English:
+- Take SQL query results and explain them in 1-3 concise, helpful sentences
+- Use hospital-friendly, non-technical language
+- Interpret status/action values clearly (e.g., "Available" = "ready to use")
+- Ensure consistency across answers, avoiding conflicting information
+- If results are empty, say: "Sorry, we couldn't find that information. Try a different search term."
+- If there's an error, say: "Sorry, there was an issue getting that information. Please try rephrasing your question."
+- For urgent/emergency equipment, start with "Urgent:" and be direct
+- NEVER mention SQL, tables, databases, or technical details
+- Focus on what hospital staff need to know
+
+Always ensure queries are syntactically correct and use proper relationships.
+"""
 
+PROMPTS["status"] = """
 ### Equipment Status Queries:
 - Use the 'status' column with valid values: 'Available', 'In use', 'Maintenance'
 - For availability queries, filter WHERE e.status ILIKE '%available%'
 - For maintenance queries, filter WHERE e.status ILIKE '%maintenance%'
+"""
 
+PROMPTS["usage"] = """
 ### Usage Tracking:
 - For "who used" queries, join usage_logs with employees
 - Do NOT use equipment.last_used_by for usage queries - use usage_logs table instead
 - For recent usage, prefer ul.action ILIKE '%checked out%' or ul.action ILIKE '%used%'
 - Order by ul.used_at DESC for most recent usage
+- Usage history pattern: SELECT emp.name, ul.used_at, ul.action FROM usage_logs ul JOIN employees emp ON ul.employee_id = emp.employee_id WHERE ul.equipment_id = (SELECT equipment_id FROM equipment WHERE name ILIKE '%equipment_name%') ORDER BY ul.used_at DESC
+"""
 
+PROMPTS["location"] = """
 ### Location Queries:
 - For location-based searches, join equipment with locations
 - Use building, floor, and room_number columns for location filtering
 - For "where is" queries, include location details in SELECT
-
-### Common Query Patterns:
-- Equipment search: SELECT e.name, e.model, e.type, e.status FROM equipment e WHERE e.name ILIKE '%search_term%'
-- Location search: SELECT e.name, l.building, l.floor, l.room_number FROM equipment e JOIN locations l ON e.location_id = l.location_id WHERE l.building ILIKE '%building_name%'
-- Usage history: SELECT emp.name, ul.used_at, ul.action FROM usage_logs ul JOIN employees emp ON ul.employee_id = emp.employee_id WHERE ul.equipment_id = (SELECT equipment_id FROM equipment WHERE name ILIKE '%equipment_name%') ORDER BY ul.used_at DESC
-
-Always ensure queries are syntactically correct and use proper relationships.
+- Location search pattern: SELECT e.name, l.building, l.floor, l.room_number FROM equipment e JOIN locations l ON e.location_id = l.location_id WHERE l.building ILIKE '%building_name%'
 """
 
-# === 🧠 System prompt for Second Agent (Result Explanation) ===
-system_prompt_agent2 = """
-You are a hospital assistant that explains database query results in plain English.
-When user greets no need to give like anything database word or related just greet them back nicely. 
-+ greet them warmly and encourage them to ask a hospital-related question.
-Take a list of query results (from execute_query tool) and/or direct explanations from the first agent and combine them into a single, clear response.
-Ensure consistency across answers, avoiding conflicting information
-Do not answer to the question that is not related to hospital equipment, staff, or locations. If user asks about something that is not related to hospital equipment, staff, or locations, just say in your words that what you are.
-- Do not mention SQL, tables, or databases in your response.
-
-Your job is to:
-- Take SQL query results and explain them in 1-3 concise, helpful sentences
-- Use hospital-friendly, non-technical language
-- Interpret status/action values clearly (e.g., "Available" = "ready to use")
-- If results are empty, say: "Sorry, we couldn't find that information. Try a different search term."
-- If there's an error, say: "Sorry, there was an issue getting that information. Please try rephrasing your question."
-- For urgent/emergency equipment, start with "Urgent:" and be direct
-- NEVER mention SQL, tables, databases, or technical details
-- Focus on what hospital staff need to know
-
-Examples:
-- "The ventilator is located in Building A, Floor 2, Room 205."
-- "The ECG machine was last used by Dr. Smith on January 15th at 2:30 PM."
-- "The defibrillator is currently available and ready to use."
-"""
+# Stable order so the composed prompt is byte-identical for the same intent
+# set (keeps provider-side prefix caching effective per intent class)
+PROMPT_SLICES = ("explain", "sql", "location", "status", "usage")
+
+GREETING_RE = re.compile(r"^\s*(hi|hello|hey|thanks|thank you|good (morning|afternoon|evening))( there)?[\s!.,]*$", re.I)
+INTENT_RES = {
+    "location": re.compile(r"\bwhere\b|\blocat|\bbuilding\b|\bfloor\b|\broom\b", re.I),
+    "status": re.compile(r"\bstatus\b|\bavailab|\bin use\b|\bmaintenance\b|\bbroken\b|\bworking\b", re.I),
+    "usage": re.compile(r"\bwho\b|\bused?\b|\busing\b|\blast\b|\bhistory\b|\bchecked out\b", re.I),
+    "explain": re.compile(r"\bwhat (is|are|does)\b|\bexplain\b|\bdefin|\bpurpose\b|\bmeans?\b", re.I),
+}
+
+def classify(text):
+    """Cheap regex intent detection. Greetings get just the base prompt;
+    anything the patterns don't recognize gets every slice so the model
+    never misses a rule it needs."""
+    if GREETING_RE.match(text):
+        return set()
+    intents = {name for name, pattern in INTENT_RES.items() if pattern.search(text)}
+    if intents & {"location", "status", "usage"}:
+        intents.add("sql")
+    if not intents:
+        return set(PROMPT_SLICES)
+    return intents
+
+def compose_prompt(text):
+    """Base prompt (schema + guardrails) plus only the slices the turn needs."""
+    intents = classify(text)
+    return "\n".join([PROMPTS["base"]] + [PROMPTS[k] for k in PROMPT_SLICES if k in intents])
 
 # === Tool config for Groq ===
-tools = [{
-    "type": "function",
-    "function": {
-        "name": "execute_query",
-        "description": "Executes a SQL query on the hospital database",
-        "parameters": {
-            "type": "object",
-            "properties": {
-                "query": {
-                    "type": "string",
-                    "description": "SQL query to execute"
-                }
-            },
-            "required": ["query"]
+# The five common query patterns are precompiled server-side as PL/pgSQL
+# procedures (see README) - calling them skips per-query SQL parse/plan and
+# narrows the attack surface. Free-form execute_query stays as the fallback.
+def _prepared_tool(name, description, param, param_desc):
+    return {
+        "type": "function",
+        "function": {
+            "name": name,
+            "description": description,
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    param: {"type": "string", "description": param_desc}
+                },
+                "required": [param]
+            }
         }
     }
-}]
+
+tools = [
+    _prepared_tool("locate_equipment",
+                   "Finds where a piece of equipment is (building, floor, room)",
+                   "p_name", "Equipment name to search for, e.g. 'ventilator'"),
+    _prepared_tool("equipment_status",
+                   "Returns the current status of a piece of equipment (Available / In use / Maintenance)",
+                   "p_name", "Equipment name to search for, e.g. 'ECG machine'"),
+    _prepared_tool("usage_history",
+                   "Who used a piece of equipment and when, most recent first",
+                   "p_name", "Equipment name to search for, e.g. 'defibrillator'"),
+    _prepared_tool("staff_in_dept",
+                   "Lists staff working in a department",
+                   "p_dept", "Department name, e.g. 'ICU'"),
+    _prepared_tool("equipment_in_building",
+                   "Lists equipment located in a building",
+                   "p_bld", "Building name, e.g. 'Building A'"),
+    {
+        "type": "function",
+        "function": {
+            "name": "execute_query",
+            "description": "Fallback: executes a raw SQL query on the hospital database. Use only when no typed lookup tool fits the question.",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "query": {
+                        "type": "string",
+                        "description": "SQL query to execute"
+                    }
+                },
+                "required": ["query"]
+            }
+        }
+    }
+]
+
+PREPARED_STATEMENTS = {
+    "locate_equipment", "equipment_status", "usage_history",
+    "staff_in_dept", "equipment_in_building",
+}
 
 # === Function to create chat completion with retry ===
-def create_chat_completion_with_retry(messages, tools=None, tool_choice="auto", max_retries=2):
+def create_chat_completion_with_retry(messages, tools=None, tool_choice="auto", max_retries=2, stream=False):
     for attempt in range(max_retries + 1):
         try:
             logging.info(f"Attempting chat completion (attempt {attempt + 1})")
-            
-            run = client.chat.completions.create(
+
+            run = get_groq().chat.completions.create(
                 model="llama-3.3-70b-versatile",  # Updated to best model
                 messages=messages,
                 temperature=0.7,
                 tools=tools,
-                tool_choice=tool_choice # type: ignore
+                tool_choice=tool_choice, # type: ignore
+                stream=stream
             )
-            
+
             return run
             
         except Exception as e:
             error_msg = str(e)
             logging.error(f"Chat completion failed (attempt {attempt + 1}): {error_msg}")
             
-            # If this is not the last attempt, wait a bit before retrying
-            if attempt < max_retries:
-                logging.info(f"Retrying chat completion in 2 seconds... (attempt {attempt + 2}/{max_retries + 1})")
-                time.sleep(2)
+            # Back off before retrying, but only when a retry can actually help
+            if attempt < max_retries and is_retryable(error_msg):
+                delay = retry_delay(attempt, error_msg)
+                logging.info(f"Retrying chat completion in {delay:.1f} seconds... (attempt {attempt + 2}/{max_retries + 1})")
+                time.sleep(delay)
             else:
-                # Final attempt failed, raise the exception
+                # Retries exhausted or a non-retryable error, raise it
                 raise e
     
     # This should never be reached, but just in case
     raise Exception("Maximum retries exceeded for chat completion")
 
+# === 🔀 Streamed agent 1 (tool-call delta aggregation) ===
+def stream_agent1(messages):
+    """Stream the tool-deciding completion. Plain replies render into the
+    chat token by token; when tool-call deltas appear instead, they are
+    aggregated into (id, name, arguments) objects for the tool path and any
+    partial text is cleared from the UI. Returns (content, tool_calls).
+    """
+    run = create_chat_completion_with_retry(messages, tools=tools, tool_choice="auto", stream=True)
+    content_parts = []
+    fragments = {}
+    placeholder = None
+
+    for chunk in run:
+        delta = chunk.choices[0].delta
+        for fragment in (delta.tool_calls or []):
+            entry = fragments.setdefault(fragment.index, {"id": None, "name": "", "arguments": []})
+            if fragment.id:
+                entry["id"] = fragment.id
+            if fragment.function:
+                if fragment.function.name:
+                    entry["name"] = fragment.function.name
+                if fragment.function.arguments:
+                    entry["arguments"].append(fragment.function.arguments)
+        if delta.content:
+            content_parts.append(delta.content)
+            if not fragments:
+                # Open the chat bubble lazily so tool-only turns don't get one
+                if placeholder is None:
+                    placeholder = st.chat_message("assistant").empty()
+                placeholder.markdown("".join(content_parts) + "▌")
+
+    content = "".join(content_parts)
+    if placeholder is not None:
+        if fragments:
+            # The text belongs to the tool path (the follow-up merges it)
+            placeholder.markdown("")
+        else:
+            placeholder.markdown(content)
+
+    tool_calls = [
+        SimpleNamespace(
+            id=entry["id"],
+            function=SimpleNamespace(name=entry["name"], arguments="".join(entry["arguments"]))
+        )
+        for _, entry in sorted(fragments.items())
+    ]
+    return content, tool_calls
+
+# === 🔀 Streamed explanation with pipelined TTS ===
+def stream_explanation_with_tts(messages):
+    """Stream the explanation completion into the chat via st.write_stream,
+    handing each finished sentence to TTS while later tokens are still
+    decoding, so synthesis overlaps LLM generation instead of waiting for
+    it. Returns (text, audio_futures) in sentence order for playback.
+    """
+    synthesize = st.session_state.voice_enabled
+    voice = st.session_state.selected_voice
+    executor = ThreadPoolExecutor(max_workers=4)
+    audio_futures = []
+
+    run = create_chat_completion_with_retry(messages, tools=None, tool_choice="auto", stream=True)
+
+    def token_feed():
+        pending = ""
+        for chunk in run:
+            delta = chunk.choices[0].delta.content or ""
+            if synthesize and delta:
+                pending += delta
+                parts = SENTENCE_SPLIT_RE.split(pending)
+                if len(parts) > 1:
+                    for sentence in parts[:-1]:
+                        if sentence.strip():
+                            audio_futures.append(executor.submit(groq_text_to_speech, sentence, voice))
+                    pending = parts[-1]
+            yield delta
+        if synthesize and pending.strip():
+            audio_futures.append(executor.submit(groq_text_to_speech, pending, voice))
+
+    with st.chat_message("assistant"):
+        text = st.write_stream(token_feed())
+    executor.shutdown(wait=False)
+
+    return text, audio_futures
+
+def play_pipelined_audio(audio_futures):
+    """Render TTS chunks whose synthesis began mid-stream: the first chunk
+    autoplays as soon as it lands, the rest are stitched and scheduled to
+    start when the first one ends (same handoff as play_audio_response)."""
+    if not audio_futures:
+        return
+    try:
+        first_audio = audio_futures[0].result()
+        if not first_audio:
+            st.warning("🔇 Could not generate voice response")
+            return
+        started_at = time.time()
+        render_audio_player(first_audio, autoplay=True)
+
+        rest_audio = [future.result() for future in audio_futures[1:]]
+        rest_audio = [chunk for chunk in rest_audio if chunk]
+        if rest_audio:
+            delay_s = max(0.0, wav_duration_seconds(first_audio) - (time.time() - started_at))
+            render_audio_player(concat_wav(rest_audio), delay_s=delay_s)
+    except Exception as e:
+        logging.error(f"Audio playback failed: {str(e)}")
+        st.warning("🔇 Voice response unavailable")
+
 # === 🎨 Streamlit UI Setup ===
 st.set_page_config(
     page_title="🏥 Hospital Voice Assistant",
@@ -356,10 +758,29 @@ st.markdown("""
 # Initialize session state
 if "messages" not in st.session_state:
     st.session_state.messages = []
+if "agent_msgs" not in st.session_state:
+    # Rolling LLM conversation buffer: appended to in place each turn
+    # instead of rebuilt from st.session_state.messages (which only holds
+    # the display transcript)
+    st.session_state.agent_msgs = [{"role": "system", "content": PROMPTS["base"]}]
+
+def trim_agent_msgs():
+    """Cap the rolling buffer at system + last 20 messages to bound token
+    cost; drop leading orphaned tool replies so the window never opens
+    mid tool-call. Returns the (possibly reassigned) buffer."""
+    msgs = st.session_state.agent_msgs
+    if len(msgs) > 21:
+        tail = msgs[-20:]
+        while tail and tail[0].get("role") == "tool":
+            tail.pop(0)
+        st.session_state.agent_msgs = [msgs[0]] + tail
+    return st.session_state.agent_msgs
 if "voice_enabled" not in st.session_state:
     st.session_state.voice_enabled = True
 if "selected_voice" not in st.session_state:
     st.session_state.selected_voice = "Judy-PlayAI"
+if "multilingual_asr" not in st.session_state:
+    st.session_state.multilingual_asr = False
 # if "input" not in st.session_state:
 #     st.session_state.input_type = None
 
@@ -402,38 +823,217 @@ with st.sidebar:
     else:
         st.info("ℹ️ Voice response is OFF - Text only")
 
+    # ASR language preference (English-only model is ~3x faster)
+    multilingual_asr = st.checkbox("🌐 Non-English speech input (multilingual, slower)",
+                                   value=st.session_state.multilingual_asr)
+    st.session_state.multilingual_asr = multilingual_asr
+
 # === 🧹 Clean audio input after processing ===
 if "last_audio" not in st.session_state:
     st.session_state.last_audio = None
 
-# Display chat history
-for message in st.session_state.messages:
+# Display chat history. Markdown is parsed client-side by the Streamlit
+# frontend, so pre-rendering HTML server-side wouldn't save anything; the
+# win is not re-laying-out every old message on each rerun. Recent messages
+# render normally, older ones collapse into an expander the browser only
+# lays out when opened.
+HISTORY_WINDOW = 20
+earlier_messages = st.session_state.messages[:-HISTORY_WINDOW]
+if earlier_messages:
+    with st.expander(f"📜 Show {len(earlier_messages)} earlier messages"):
+        for message in earlier_messages:
+            with st.chat_message(message["role"]):
+                st.markdown(message["content"])
+for message in st.session_state.messages[-HISTORY_WINDOW:]:
     with st.chat_message(message["role"]):
         st.markdown(message["content"])
 
+# Function to render a single audio player
+def render_audio_player(audio_content, autoplay=False, delay_s=0.0):
+    """Render an audio player. Undelayed chunks go through st.audio, which
+    streams the WAV over Streamlit's media endpoint instead of inflating it
+    ~33% into a base64 data: URI inside the page HTML. A positive delay
+    still needs the tiny JS scheduler (st.audio has no deferred start), so
+    only the stitched tail pays the base64 cost."""
+    if delay_s > 0:
+        audio_b64 = base64.b64encode(audio_content).decode()
+        components.html(f"""
+            <audio id="tts-tail" controls style="width: 100%;">
+                <source src="data:audio/wav;base64,{audio_b64}" type="audio/wav">
+            </audio>
+            <script>
+                setTimeout(function() {{ document.getElementById("tts-tail").play(); }}, {int(delay_s * 1000)});
+            </script>
+        """, height=60)
+    else:
+        st.audio(audio_content, format="audio/wav", autoplay=autoplay)
+
 # Function to play audio response
 def play_audio_response(text):
-    """Generate and play audio response using Groq TTS"""
+    """Generate and play audio response using Groq TTS.
+
+    The reply is split at sentence boundaries and synthesized in parallel, so
+    the first sound arrives after the shortest chunk instead of after the
+    whole response; the remaining chunks are stitched into one WAV whose
+    playback is scheduled for when the first chunk ends.
+    """
     if st.session_state.voice_enabled:
         with st.spinner("🔊 Generating voice response..."):
             try:
-                audio_content = groq_text_to_speech(text, voice=st.session_state.selected_voice)
-                if audio_content:
-                    # Convert to base64 for HTML audio player
-                    audio_b64 = base64.b64encode(audio_content).decode()
-                    audio_html = f"""
-                    <audio controls autoplay style="width: 100%;">
-                        <source src="data:audio/wav;base64,{audio_b64}" type="audio/wav">
-                        Your browser does not support the audio element.
-                    </audio>
-                    """
-                    st.markdown(audio_html, unsafe_allow_html=True)
-                else:
-                    st.warning("🔇 Could not generate voice response")
+                chunks = split_into_sentences(text)
+                if not chunks:
+                    return
+
+                voice = st.session_state.selected_voice
+                with ThreadPoolExecutor(max_workers=4) as executor:
+                    futures = [executor.submit(groq_text_to_speech, chunk, voice) for chunk in chunks]
+
+                    first_audio = futures[0].result()
+                    if not first_audio:
+                        st.warning("🔇 Could not generate voice response")
+                        return
+                    started_at = time.time()
+                    render_audio_player(first_audio, autoplay=True)
+
+                    rest_audio = [future.result() for future in futures[1:]]
+
+                rest_audio = [chunk for chunk in rest_audio if chunk]
+                if rest_audio:
+                    # Hand off roughly when the first chunk finishes playing
+                    delay_s = max(0.0, wav_duration_seconds(first_audio) - (time.time() - started_at))
+                    render_audio_player(concat_wav(rest_audio), delay_s=delay_s)
             except Exception as e:
                 logging.error(f"Audio playback failed: {str(e)}")
                 st.warning("🔇 Voice response unavailable")
                 
+# === 🧵 Shared turn handler (voice and text paths) ===
+def handle_user_turn(user_input, *, is_voice=False):
+    """Run one conversation turn: record the user message, stream the
+    tool-deciding completion, execute any tool calls, stream the final
+    explanation and voice it. Voice turns only differ by the mic prefix
+    on the user bubble."""
+    # Add user message to chat history
+    st.session_state.messages.append({"role": "user", "content": user_input})
+    with st.chat_message("user"):
+        st.markdown(f"🎤 {user_input}" if is_voice else user_input)
+
+    with st.spinner("🤖 Thinking..."):
+        try:
+            # Append to the rolling buffer instead of rebuilding the
+            # whole history (O(1) per turn, keeps tool context)
+            messages_agent1 = trim_agent_msgs()
+            # Swap in the intent-sliced prompt for this turn
+            messages_agent1[0] = {"role": "system", "content": compose_prompt(user_input)}
+            messages_agent1.append({"role": "user", "content": user_input})
+
+            # Let the model decide whether to use tools or not; plain
+            # replies stream into the chat as they decode
+            agent1_content, agent1_tool_calls = stream_agent1(messages_agent1)
+            logging.info(f"Raw response: {agent1_content!r}")
+
+            # Check if tool calls are present
+            has_tool_calls = bool(agent1_tool_calls)
+
+            # If NO tool calls and there's a message, it was already
+            # rendered while streaming - just record and voice it
+            if not has_tool_calls and agent1_content:
+                final_response = agent1_content.strip()
+                logging.info(f"🟢 Direct reply from Agent 1 (no tool call): {final_response}")
+                messages_agent1.append({"role": "assistant", "content": final_response})
+                st.session_state.messages.append({"role": "assistant", "content": final_response})
+
+                # Play audio response
+                play_audio_response(final_response)
+
+            elif has_tool_calls:
+                # Execute the tool calls and feed the results straight
+                # back into the same conversation - no second agent
+                messages_agent1.append({
+                    "role": "assistant",
+                    "content": agent1_content or None,
+                    "tool_calls": [
+                        {
+                            "id": tool_call.id,
+                            "type": "function",
+                            "function": {
+                                "name": tool_call.function.name,
+                                "arguments": tool_call.function.arguments,
+                            },
+                        }
+                        for tool_call in agent1_tool_calls
+                    ],
+                })
+
+                # Raw-SQL calls go to Supabase as one batched RPC, and the
+                # typed lookups - the prompt-steered common path - run
+                # concurrently beside it instead of one serial RPC each, so
+                # a multi-question turn waits for the slowest call, not the
+                # sum of them
+                sql_calls = []
+                prepared_calls = []
+                for idx, tool_call in enumerate(agent1_tool_calls, 1):
+                    if tool_call.function.name == "execute_query":
+                        sql_calls.append((idx, tool_call))
+                    elif tool_call.function.name in PREPARED_STATEMENTS:
+                        prepared_calls.append((idx, tool_call))
+
+                tool_outputs = {}
+                if sql_calls or prepared_calls:
+                    with ThreadPoolExecutor(max_workers=8) as executor:
+                        batch_future = executor.submit(execute_query_batch, sql_calls) if sql_calls else None
+                        prepared_futures = {
+                            executor.submit(execute_prepared, tool_call.function.name, tool_call.function.arguments): idx
+                            for idx, tool_call in prepared_calls
+                        }
+                        if batch_future is not None:
+                            tool_outputs.update(batch_future.result())
+                        for future, idx in prepared_futures.items():
+                            tool_outputs[idx] = future.result()
+
+                for idx, tool_call in enumerate(agent1_tool_calls, 1):
+                    if idx in tool_outputs:
+                        tool_output = tool_outputs[idx]
+                        logging.info(f"Tool call {idx} executed: {tool_call.function.name} → {tool_call.function.arguments}")
+                    else:
+                        tool_output = json.dumps({"error": f"Unknown tool: {tool_call.function.name}"})
+                    messages_agent1.append({
+                        "role": "tool",
+                        "tool_call_id": tool_call.id,
+                        "content": tool_output,
+                    })
+
+                # Stream the explanation into the chat and hand
+                # finished sentences to TTS mid-decode
+                final_response, audio_futures = stream_explanation_with_tts(messages_agent1)
+
+                # Final output
+                messages_agent1.append({"role": "assistant", "content": final_response})
+                st.session_state.messages.append({"role": "assistant", "content": final_response})
+
+                # Play audio response (synthesis already started mid-stream)
+                if audio_futures:
+                    play_pipelined_audio(audio_futures)
+                else:
+                    play_audio_response(final_response)
+
+            else:
+                final_response = "⚠️ Sorry, I couldn't understand. Try rephrasing."
+                messages_agent1.append({"role": "assistant", "content": final_response})
+                st.session_state.messages.append({"role": "assistant", "content": final_response})
+                with st.chat_message("assistant"):
+                    st.markdown(final_response)
+                play_audio_response(final_response)
+
+        except Exception as e:
+            logging.error(f"Final error after all retries: {str(e)}")
+            error_msg = "⚠️ Sorry, there was an issue processing your request. Please try again in a moment."
+            st.session_state.messages.append({"role": "assistant", "content": error_msg})
+            with st.chat_message("assistant"):
+                st.markdown(error_msg)
+
+            # Play error audio response
+            play_audio_response(error_msg)
+
 input_container = st.container()
 with input_container:
     col1, col2 = st.columns([1, 10])
@@ -446,7 +1046,11 @@ with input_container:
             neutral_color="#6aa36f",
             icon_name="microphone",
             icon_size="2x",
-            pause_threshold=2.0,
+            # 2.0s of required silence was pure fixed latency on every voice
+            # turn; 0.6s still survives natural mid-sentence pauses. True
+            # VAD endpointing would need frame-level audio (streamlit-webrtc
+            # + webrtcvad) - audio_recorder only yields the finished blob.
+            pause_threshold=0.6,
             sample_rate=16000,
             # key="audio_recorder"
         )
@@ -456,110 +1060,28 @@ with input_container:
 if audio_bytes and len(audio_bytes) > 0 and audio_bytes != st.session_state.last_audio:
     # Store current audio to prevent reprocessing
     st.session_state.last_audio = audio_bytes
-    st.markdown("### 🎧 Processing Voice...")
-    
-    with st.spinner("🎙️ Converting speech to text..."):
-        transcribed_text = transcribe_audio(audio_bytes)
+
+    # Kick off ASR on a worker thread the moment the blob arrives so the
+    # network round-trip overlaps the UI rendering below instead of
+    # following it. (Transcribing while the user is still talking would
+    # need frame-level audio via something like streamlit-webrtc -
+    # audio_recorder only hands over the finished blob, and Groq's
+    # transcription endpoint takes whole files.)
+    asr_model = ASR_MODEL_MULTILINGUAL if st.session_state.multilingual_asr else ASR_MODEL
+    with ThreadPoolExecutor(max_workers=1) as asr_executor:
+        transcription_future = asr_executor.submit(transcribe_audio, audio_bytes, asr_model)
+
+        st.markdown("### 🎧 Processing Voice...")
+
+        with st.spinner("🎙️ Converting speech to text..."):
+            transcribed_text = transcription_future.result()
     
     if transcribed_text:
         st.success(f"🎯 Heard: \"{transcribed_text}\"")
         user_input = transcribed_text
         
-        # Add user message to chat history
-        st.session_state.messages.append({"role": "user", "content": user_input})
-        with st.chat_message("user"):
-            st.markdown(f"🎤 {user_input}")
-        
-        # Process the transcribed input
-        with st.spinner("🤖 Thinking..."):
-            try:
-                # Build full conversation history for agent1
-                messages_agent1 = [{"role": "system", "content": system_prompt_agent1}]
-                for msg in st.session_state.messages:
-                    messages_agent1.append({"role": msg["role"], "content": msg["content"]})
-                messages_agent1.append({"role": "user", "content": user_input})
-
-                # Let the model decide whether to use tools or not
-                run = create_chat_completion_with_retry(messages_agent1, tools=tools, tool_choice="auto")
-                response = run.choices[0].message
-                logging.info(f"Raw response: {response.content!r}")
-
-                # Check if tool calls are present
-                has_tool_calls = hasattr(response, "tool_calls") and response.tool_calls
-
-                # If NO tool calls and there's a message, just show it directly
-                if not has_tool_calls and response.content:
-                    final_response = response.content.strip()
-                    logging.info(f"🟢 Direct reply from Agent 1 (no tool call): {final_response}")
-                    st.session_state.messages.append({"role": "assistant", "content": final_response})
-                    with st.chat_message("assistant"):
-                        st.markdown(final_response)
-                    
-                    # Play audio response
-                    play_audio_response(final_response)
-                            
-                else:
-                    # If there are tool calls, execute them
-                    query_results = []
-                    final_responses = []
-
-                    if has_tool_calls:
-                        for idx, tool_call in enumerate(response.tool_calls, 1): # type: ignore
-                            if tool_call.function.name == "execute_query":
-                                tool_output = execute_query_groq(tool_call.function.arguments)
-                                logging.info(f"Tool call {idx} executed: {tool_call.function.name} → {tool_call.function.arguments}")
-                                query_results.append({"index": idx, "result": tool_output})
-                            else:
-                                final_responses.append(f"{idx}. ⚠️ Couldn't process part of your request. Try rephrasing.")
-
-                    # Collect direct assistant content
-                    if response.content:
-                        if response.content.strip().startswith("1"):
-                            final_responses.extend(response.content.strip().split("\n"))
-                        else:
-                            final_responses.append(response.content)
-
-                    # Send to Agent 2 (if needed)
-                    if query_results or final_responses:
-                        messages_agent2 = [{"role": "system", "content": system_prompt_agent2}]
-                        for msg in st.session_state.messages:
-                            messages_agent2.append({"role": msg["role"], "content": msg["content"]})
-
-                        for query_result in query_results:
-                            messages_agent2.append({
-                                "role": "function",
-                                "name": "execute_query",
-                                "content": query_result["result"]
-                            })
-
-                        if final_responses and not all("⚠️" in r for r in final_responses):
-                            messages_agent2.append({
-                                "role": "assistant",
-                                "content": "\n".join(final_responses)
-                            })
-
-                        explanation_run = create_chat_completion_with_retry(messages_agent2, tools=None, tool_choice="auto")
-                        final_response = explanation_run.choices[0].message.content
-                    else:
-                        final_response = "⚠️ Sorry, I couldn't understand. Try rephrasing."
-
-                    # Final output from Agent 2
-                    st.session_state.messages.append({"role": "assistant", "content": final_response})
-                    with st.chat_message("assistant"):
-                        st.markdown(final_response)
-                    
-                    # Play audio response
-                    play_audio_response(final_response)
-                            
-            except Exception as e:
-                logging.error(f"Final error after all retries: {str(e)}")
-                error_msg = "⚠️ Sorry, there was an issue processing your request. Please try again in a moment."
-                st.session_state.messages.append({"role": "assistant", "content": error_msg})
-                with st.chat_message("assistant"):
-                    st.markdown(error_msg)
-                
-                # Play error audio response
-                play_audio_response(error_msg)
+        # Process the transcribed input through the shared turn handler
+        handle_user_turn(user_input, is_voice=True)
     
     else:
         st.error("❌ Could not transcribe audio. Please try again.")
@@ -575,100 +1097,7 @@ if user_input and user_input.strip():
         
     if user_input != st.session_state.last_text:
         st.session_state.last_text = user_input
-        # Add user message to chat history
-        st.session_state.messages.append({"role": "user", "content": user_input})
-        with st.chat_message("user"):
-            st.markdown(user_input)
-
-        with st.spinner("🤖 Thinking..."):
-            try:
-                # Build full conversation history for agent1
-                messages_agent1 = [{"role": "system", "content": system_prompt_agent1}]
-                for msg in st.session_state.messages:
-                    messages_agent1.append({"role": msg["role"], "content": msg["content"]})
-                messages_agent1.append({"role": "user", "content": user_input})  # Add current input
-
-                # Let the model decide whether to use tools or not
-                run = create_chat_completion_with_retry(messages_agent1, tools=tools, tool_choice="auto")
-                response = run.choices[0].message
-                logging.info(f"Raw response: {response.content!r}")
-
-                # Check if tool calls are present
-                has_tool_calls = hasattr(response, "tool_calls") and response.tool_calls
-
-                # If NO tool calls and there's a message, just show it directly
-                if not has_tool_calls and response.content:
-                    final_response = response.content.strip()
-                    logging.info(f"🟢 Direct reply from Agent 1 (no tool call): {final_response}")
-                    st.session_state.messages.append({"role": "assistant", "content": final_response})
-                    with st.chat_message("assistant"):
-                        st.markdown(final_response)
-                    
-                    # Play audio response
-                    play_audio_response(final_response)
-                            
-                else:
-                    # If there are tool calls, execute them
-                    query_results = []
-                    final_responses = []
-
-                    if has_tool_calls:
-                        for idx, tool_call in enumerate(response.tool_calls, 1): # type: ignore
-                            if tool_call.function.name == "execute_query":
-                                tool_output = execute_query_groq(tool_call.function.arguments)
-                                logging.info(f"Tool call {idx} executed: {tool_call.function.name} → {tool_call.function.arguments}")
-                                query_results.append({"index": idx, "result": tool_output})
-                            else:
-                                final_responses.append(f"{idx}. ⚠️ Couldn't process part of your request. Try rephrasing.")
-
-                    # Collect direct assistant content
-                    if response.content:
-                        if response.content.strip().startswith("1"):
-                            final_responses.extend(response.content.strip().split("\n"))
-                        else:
-                            final_responses.append(response.content)
-
-                    # Send to Agent 2 (if needed)
-                    if query_results or final_responses:
-                        messages_agent2 = [{"role": "system", "content": system_prompt_agent2}]
-                        for msg in st.session_state.messages:
-                            messages_agent2.append({"role": msg["role"], "content": msg["content"]})
-
-                        for query_result in query_results:
-                            messages_agent2.append({
-                                "role": "function",
-                                "name": "execute_query",
-                                "content": query_result["result"]
-                            })
-
-                        if final_responses and not all("⚠️" in r for r in final_responses):
-                            messages_agent2.append({
-                                "role": "assistant",
-                                "content": "\n".join(final_responses)
-                            })
-
-                        explanation_run = create_chat_completion_with_retry(messages_agent2, tools=None, tool_choice="auto")
-                        final_response = explanation_run.choices[0].message.content
-                    else:
-                        final_response = "⚠️ Sorry, I couldn't understand. Try rephrasing."
-
-                    # Final output from Agent 2
-                    st.session_state.messages.append({"role": "assistant", "content": final_response})
-                    with st.chat_message("assistant"):
-                        st.markdown(final_response)
-                    
-                    # Play audio response
-                    play_audio_response(final_response)
-                            
-            except Exception as e:
-                logging.error(f"Final error after all retries: {str(e)}")
-                error_msg = "⚠️ Sorry, there was an issue processing your request. Please try again in a moment."
-                st.session_state.messages.append({"role": "assistant", "content": error_msg})
-                with st.chat_message("assistant"):
-                    st.markdown(error_msg)
-                
-                # Play error audio response
-                play_audio_response(error_msg)
+        handle_user_turn(user_input)
 
 # Footer
 with st.sidebar: